@@ -1,8 +1,9 @@
 import asyncio
-import json
 import uuid
+from collections import deque
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, List, Optional, Type
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple, Type
 
 import structlog
 from alembic import command as alembic_command
@@ -11,7 +12,7 @@ from pydantic import BaseModel
 from sqlalchemy import CursorResult, TextClause, event, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, OperationalError
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.ext.asyncio import AsyncConnection, create_async_engine
 
 from codegate.db.fim_cache import FimCache
 from codegate.db.models import (
@@ -38,6 +39,74 @@ alert_queue = asyncio.Queue()
 fim_cache = FimCache()
 
 
+# Applied to every new connection of the CodeGate DB engine. WAL lets the readers proceed
+# concurrently with the writer and, together with synchronous=NORMAL, avoids an fsync per commit.
+# [SQLite docs](https://www.sqlite.org/wal.html)
+SQLITE_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+)
+# Maximum number of queued writes the background writer commits in a single transaction.
+WRITER_MAX_BATCH_SIZE = 100
+
+# A write is a list of statements, each one with the parameters of every row to insert.
+WriteStatements = List[Tuple[TextClause, List[dict]]]
+
+# Statements used on every recorded context, built once so they aren't recreated per request.
+INSERT_PROMPT_SQL = text(
+    """
+    INSERT INTO prompts (id, timestamp, provider, request, type, workspace_id)
+    VALUES (:id, :timestamp, :provider, :request, :type, :workspace_id)
+    ON CONFLICT(id) DO UPDATE SET
+    timestamp = excluded.timestamp, provider = excluded.provider,
+    request = excluded.request, type = excluded.type,
+    workspace_id = excluded.workspace_id
+    """
+)
+UPDATE_PROMPT_SQL = text(
+    """
+    UPDATE prompts
+    SET timestamp = :timestamp, provider = :provider, request = :request, type = :type
+    WHERE id = :id
+    """
+)
+INSERT_OUTPUT_SQL = text(
+    """
+    INSERT INTO outputs (
+        id, prompt_id, timestamp, output, input_tokens, output_tokens, input_cost,
+        output_cost
+    )
+    VALUES (
+        :id, :prompt_id, :timestamp, :output, :input_tokens, :output_tokens,
+        :input_cost, :output_cost
+    )
+    ON CONFLICT (id) DO UPDATE SET
+    timestamp = excluded.timestamp,
+    output = excluded.output,
+    input_tokens = excluded.input_tokens,
+    output_tokens = excluded.output_tokens,
+    input_cost = excluded.input_cost,
+    output_cost = excluded.output_cost
+    """
+)
+INSERT_ALERT_SQL = text(
+    """
+    INSERT INTO alerts (
+    id, prompt_id, code_snippet, trigger_string, trigger_type, trigger_category,
+    timestamp
+    )
+    VALUES (:id, :prompt_id, :code_snippet, :trigger_string, :trigger_type,
+    :trigger_category, :timestamp)
+    ON CONFLICT (id) DO UPDATE SET
+    code_snippet = excluded.code_snippet, trigger_string = excluded.trigger_string,
+    trigger_type = excluded.trigger_type, trigger_category = excluded.trigger_category,
+    timestamp = excluded.timestamp, prompt_id = excluded.prompt_id
+    """
+)
+
+
 class AlreadyExistsError(Exception):
     pass
 
@@ -84,6 +153,21 @@ class DbCodeGate:
                 "isolation_level": "AUTOCOMMIT",  # Required for SQLite
             }
             self._async_db_engine = create_async_engine(**engine_dict)
+            self._wal_enabled = False
+            event.listen(self._async_db_engine.sync_engine, "connect", self._set_connection_pragmas)
+
+    def _set_connection_pragmas(self, dbapi_connection, connection_record):
+        """
+        Tune every new connection of the engine. The journal mode is persisted in the DB file,
+        so it only needs to be set once per engine.
+        """
+        cursor = dbapi_connection.cursor()
+        if not self._wal_enabled:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            self._wal_enabled = True
+        for pragma in SQLITE_CONNECTION_PRAGMAS:
+            cursor.execute(pragma)
+        cursor.close()
 
     def does_db_exist(self):
         return self._db_path.is_file()
@@ -92,14 +176,101 @@ class DbCodeGate:
 class DbRecorder(DbCodeGate):
     def __init__(self, sqlite_path: Optional[str] = None):
         super().__init__(sqlite_path)
+        if not hasattr(self, "_writer_task"):
+            self._pending_writes: Deque[Tuple[WriteStatements, asyncio.Future]] = deque()
+            self._writer_task: Optional[asyncio.Task] = None
+
+    async def _write(self, statements: WriteStatements) -> None:
+        """Hand the statements to the background writer and wait until they are committed."""
+        loop = asyncio.get_running_loop()
+        if self._writer_task is not None and self._writer_task.get_loop() is not loop:
+            # The CLI runs some commands with asyncio.run before starting the server. Whatever
+            # was left from a previous event loop can't be resolved anymore.
+            self._pending_writes.clear()
+            self._writer_task = None
+
+        future = loop.create_future()
+        self._pending_writes.append((statements, future))
+        # The writer runs while there are pending writes and exits once they are drained.
+        if self._writer_task is None or self._writer_task.done():
+            self._writer_task = loop.create_task(self._run_writer())
+        await future
+
+    async def _run_writer(self) -> None:
+        """
+        Drain the pending writes, committing all the writes queued so far in a single
+        transaction. If the transaction fails, the writes are retried one by one so a bad row
+        only fails the write that contains it.
+        """
+        while self._pending_writes:
+            writes = []
+            while self._pending_writes and len(writes) < WRITER_MAX_BATCH_SIZE:
+                writes.append(self._pending_writes.popleft())
+
+            errors: List[Optional[Exception]] = [None] * len(writes)
+            try:
+                await self._commit_statements([statements for statements, _ in writes])
+            except Exception as e:
+                if len(writes) == 1:
+                    errors = [e]
+                else:
+                    logger.warning("Failed to commit queued writes, retrying them one by one.")
+                    errors = [await self._try_commit(statements) for statements, _ in writes]
+
+            for (_, future), error in zip(writes, errors):
+                # The future is already done if the caller was cancelled while waiting.
+                if future.done():
+                    continue
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+
+    async def _try_commit(self, statements: WriteStatements) -> Optional[Exception]:
+        try:
+            await self._commit_statements([statements])
+        except Exception as e:
+            return e
+        return None
+
+    async def _commit_statements(self, writes: List[WriteStatements]) -> None:
+        """Execute the writes in one transaction, with one executemany per distinct statement."""
+        grouped: Dict[str, Tuple[TextClause, List[dict]]] = {}
+        for statements in writes:
+            for sql, params in statements:
+                grouped.setdefault(sql.text, (sql, []))[1].extend(params)
+
+        async with self._async_db_engine.connect() as conn:
+            # The engine runs in AUTOCOMMIT, so the transaction is handled explicitly. Grouping
+            # by statement can reorder the inserts, hence foreign keys are checked on commit.
+            await conn.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                await conn.exec_driver_sql("PRAGMA defer_foreign_keys=ON")
+                for sql, params in grouped.values():
+                    await conn.execute(sql, params)
+                await conn.exec_driver_sql("COMMIT")
+            except Exception:
+                await conn.exec_driver_sql("ROLLBACK")
+                raise
 
     async def _execute_update_pydantic_model(
-        self, model: BaseModel, sql_command: TextClause, should_raise: bool = False
+        self,
+        model: BaseModel,
+        sql_command: TextClause,
+        should_raise: bool = False,
+        fetch: bool = True,
     ) -> Optional[BaseModel]:
-        """Execute an update or insert command for a Pydantic model."""
+        """
+        Execute an update or insert command for a Pydantic model.
+
+        When `fetch` is False the caller doesn't need the resulting row, so the command should
+        not have a RETURNING clause and None is returned.
+        """
         try:
             async with self._async_db_engine.begin() as conn:
                 result = await conn.execute(sql_command, model.model_dump())
+                if not fetch:
+                    return None
                 row = result.first()
                 if row is None:
                     return None
@@ -108,7 +279,7 @@ class DbRecorder(DbCodeGate):
                 model_class = model.__class__
                 return model_class(**row._asdict())
         except Exception as e:
-            logger.error(f"Failed to update model: {model}.", error=str(e))
+            logger.error("Failed to update model.", model_type=type(model).__name__, error=str(e))
             if should_raise:
                 raise e
             return None
@@ -122,28 +293,76 @@ class DbRecorder(DbCodeGate):
             logger.error(f"Failed to execute command: {sql_command}.", error=str(e))
             raise e
 
-    async def record_request(self, prompt_params: Optional[Prompt] = None) -> Optional[Prompt]:
-        if prompt_params is None:
-            return None
+    async def _request_statements(self, prompt_params: Prompt) -> WriteStatements:
         # Get the active workspace to store the request
         active_workspace = await DbReader().get_active_workspace()
         workspace_id = active_workspace.id if active_workspace else "1"
         prompt_params.workspace_id = workspace_id
-        sql = text(
-            """
-                INSERT INTO prompts (id, timestamp, provider, request, type, workspace_id)
-                VALUES (:id, :timestamp, :provider, :request, :type, :workspace_id)
-                ON CONFLICT(id) DO UPDATE SET
-                timestamp = excluded.timestamp, provider = excluded.provider,
-                request = excluded.request, type = excluded.type,
-                workspace_id = excluded.workspace_id
-                RETURNING *
-                """
-        )
-        recorded_request = await self._execute_update_pydantic_model(prompt_params, sql)
+        return [(INSERT_PROMPT_SQL, [prompt_params.model_dump()])]
+
+    def _update_request_statements(self, initial_id: str, prompt_params: Prompt) -> WriteStatements:
+        prompt_params.id = initial_id  # overwrite the initial id of the request
+        return [(UPDATE_PROMPT_SQL, [prompt_params.model_dump()])]
+
+    async def _output_params(self, outputs: List[Output], initial_id: Optional[str]) -> dict:
+        first_output = outputs[0]
+        # Create a single entry on DB but encode all of the chunks in the stream as a list
+        # of JSON objects in the field `output`
+        if initial_id:
+            first_output.prompt_id = initial_id
+        # Each output is already a serialized JSON object, so they are joined into a JSON list
+        # instead of being encoded again as a list of JSON strings. The brackets and separators
+        # are part of the same join, so the payload is built in one allocation.
+        output_parts = ["["]
+        for output in outputs:
+            output_parts.append(output.output)
+            output_parts.append(",")
+        output_parts[-1] = "]"
+
+        # Parse the token usage from the outputs
+        token_parser = TokenUsageParser()
+        full_token_usage = await token_parser.parse_outputs(outputs)
+
+        # The values come from outputs that were already validated, so they are passed
+        # straight as the statement parameters instead of building another Output.
+        return {
+            "id": first_output.id,
+            "prompt_id": first_output.prompt_id,
+            "timestamp": first_output.timestamp,
+            "output": "".join(output_parts),
+            "input_tokens": full_token_usage.input_tokens,
+            "output_tokens": full_token_usage.output_tokens,
+            "input_cost": full_token_usage.input_cost,
+            "output_cost": full_token_usage.output_cost,
+        }
+
+    def _alerts_params(self, alerts: List[Alert], initial_id: Optional[str]) -> List[dict]:
+        if initial_id:
+            for alert in alerts:
+                alert.prompt_id = initial_id
+        return [alert.model_dump() for alert in alerts]
+
+    async def _notify_critical_alerts(self, alerts: List[Alert]) -> None:
+        critical_alert_timestamp = None
+        for alert in alerts:
+            if alert.trigger_category == "critical":
+                critical_alert_timestamp = alert.timestamp
+
+        # only alert once per request and not once per critical alert.
+        if critical_alert_timestamp:
+            await alert_queue.put(f"New alert detected: {critical_alert_timestamp}")
+
+    async def record_request(self, prompt_params: Optional[Prompt] = None) -> Optional[Prompt]:
+        if prompt_params is None:
+            return None
+        try:
+            await self._write(await self._request_statements(prompt_params))
+        except Exception as e:
+            logger.error("Failed to record request.", prompt_id=prompt_params.id, error=str(e))
+            return None
         # Uncomment to debug the recorded request
-        # logger.debug(f"Recorded request: {recorded_request}")
-        return recorded_request  # type: ignore
+        # logger.debug(f"Recorded request: {prompt_params}")
+        return prompt_params
 
     async def update_request(
         self, initial_id: str, prompt_params: Optional[Prompt] = None
@@ -170,102 +389,32 @@ class DbRecorder(DbCodeGate):
         if not outputs:
             return
 
-        first_output = outputs[0]
-        # Create a single entry on DB but encode all of the chunks in the stream as a list
-        # of JSON objects in the field `output`
-        if initial_id:
-            first_output.prompt_id = initial_id
-        output_db = Output(
-            id=first_output.id,
-            prompt_id=first_output.prompt_id,
-            timestamp=first_output.timestamp,
-            output=first_output.output,
-        )
-        full_outputs = []
-        # Just store the model respnses in the list of JSON objects.
-        for output in outputs:
-            full_outputs.append(output.output)
-
-        # Parse the token usage from the outputs
-        token_parser = TokenUsageParser()
-        full_token_usage = await token_parser.parse_outputs(outputs)
-
-        output_db.output = json.dumps(full_outputs)
-        output_db.input_tokens = full_token_usage.input_tokens
-        output_db.output_tokens = full_token_usage.output_tokens
-        output_db.input_cost = full_token_usage.input_cost
-        output_db.output_cost = full_token_usage.output_cost
-
-        sql = text(
-            """
-                INSERT INTO outputs (
-                    id, prompt_id, timestamp, output, input_tokens, output_tokens, input_cost,
-                    output_cost
-                )
-                VALUES (
-                    :id, :prompt_id, :timestamp, :output, :input_tokens, :output_tokens,
-                    :input_cost, :output_cost
-                )
-                ON CONFLICT (id) DO UPDATE SET
-                timestamp = excluded.timestamp,
-                output = excluded.output,
-                input_tokens = excluded.input_tokens,
-                output_tokens = excluded.output_tokens,
-                input_cost = excluded.input_cost,
-                output_cost = excluded.output_cost
-                RETURNING *
-                """
-        )
-        recorded_output = await self._execute_update_pydantic_model(output_db, sql)
+        output_params = await self._output_params(outputs, initial_id)
+        try:
+            await self._write([(INSERT_OUTPUT_SQL, [output_params])])
+        except Exception as e:
+            logger.error("Failed to record output.", output_id=output_params["id"], error=str(e))
+            return None
         # Uncomment to debug
-        # logger.debug(f"Recorded output: {recorded_output}")
-        return recorded_output  # type: ignore
+        # logger.debug(f"Recorded output: {output_params}")
+        return Output.model_construct(**output_params)
 
     async def record_alerts(self, alerts: List[Alert], initial_id: Optional[str]) -> List[Alert]:
         if not alerts:
             return []
-        sql = text(
-            """
-                INSERT INTO alerts (
-                id, prompt_id, code_snippet, trigger_string, trigger_type, trigger_category,
-                timestamp
-                )
-                VALUES (:id, :prompt_id, :code_snippet, :trigger_string, :trigger_type,
-                :trigger_category, :timestamp)
-                ON CONFLICT (id) DO UPDATE SET
-                code_snippet = excluded.code_snippet, trigger_string = excluded.trigger_string,
-                trigger_type = excluded.trigger_type, trigger_category = excluded.trigger_category,
-                timestamp = excluded.timestamp, prompt_id = excluded.prompt_id
-                RETURNING *
-                """
-        )
-        # We can insert each alert independently in parallel.
-        alerts_tasks = []
-        async with asyncio.TaskGroup() as tg:
-            for alert in alerts:
-                try:
-                    if initial_id:
-                        alert.prompt_id = initial_id
-                    result = tg.create_task(self._execute_update_pydantic_model(alert, sql))
-                    alerts_tasks.append(result)
-                except Exception as e:
-                    logger.error(f"Failed to record alert: {alert}.", error=str(e))
-
-        critical_alert_timestamp = None
-        recorded_alerts = []
-        for alert_coro in alerts_tasks:
-            alert_result = alert_coro.result()
-            recorded_alerts.append(alert_result)
-            if alert_result and alert_result.trigger_category == "critical":
-                critical_alert_timestamp = alert.timestamp
 
-        # only alert once per request and not once per critical alert.
-        if critical_alert_timestamp:
-            await alert_queue.put(f"New alert detected: {critical_alert_timestamp}")
+        # Insert all the alerts at once. We already have the trigger category in the input
+        # models, so there's no need to return the inserted rows.
+        try:
+            await self._write([(INSERT_ALERT_SQL, self._alerts_params(alerts, initial_id))])
+        except Exception as e:
+            logger.error("Failed to record alerts.", alerts=len(alerts), error=str(e))
+            return []
 
+        await self._notify_critical_alerts(alerts)
         # Uncomment to debug the recorded alerts
-        # logger.debug(f"Recorded alerts: {recorded_alerts}")
-        return recorded_alerts
+        # logger.debug(f"Recorded alerts: {alerts}")
+        return alerts
 
     def _should_record_context(self, context: Optional[PipelineContext]) -> tuple:
         """Check if the context should be recorded in DB and determine the action."""
@@ -279,6 +428,19 @@ class DbRecorder(DbCodeGate):
 
         return fim_cache.could_store_fim_request(context)  # type: ignore
 
+    async def _context_statements(
+        self, context: PipelineContext, initial_id: Optional[str]
+    ) -> WriteStatements:
+        """Get the statements to record the outputs and alerts of a context."""
+        statements = []
+        if context.output_responses:
+            output_params = await self._output_params(context.output_responses, initial_id)
+            statements.append((INSERT_OUTPUT_SQL, [output_params]))
+        if context.alerts_raised:
+            alerts_params = self._alerts_params(context.alerts_raised, initial_id)
+            statements.append((INSERT_ALERT_SQL, alerts_params))
+        return statements
+
     async def record_context(self, context: Optional[PipelineContext]) -> None:
         try:
             if not context:
@@ -288,25 +450,24 @@ class DbRecorder(DbCodeGate):
             if not should_record:
                 logger.info("Skipping record of context, not needed")
                 return
+            # The request, outputs and alerts of the context are committed in one transaction.
             if action == "add":
-                await self.record_request(context.input_request)
-                await self.record_outputs(context.output_responses, None)
-                await self.record_alerts(context.alerts_raised, None)
-                logger.info(
-                    f"Recorded context in DB. Output chunks: {len(context.output_responses)}. "
-                    f"Alerts: {len(context.alerts_raised)}."
-                )
+                statements = await self._request_statements(context.input_request)
+                statements.extend(await self._context_statements(context, None))
+                await self._write(statements)
             else:
                 # update them
-                await self.update_request(initial_id, context.input_request)
-                await self.record_outputs(context.output_responses, initial_id)
-                await self.record_alerts(context.alerts_raised, initial_id)
-                logger.info(
-                    f"Recorded context in DB. Output chunks: {len(context.output_responses)}. "
-                    f"Alerts: {len(context.alerts_raised)}."
-                )
+                statements = self._update_request_statements(initial_id, context.input_request)
+                statements.extend(await self._context_statements(context, initial_id))
+                await self._write(statements)
+            await self._notify_critical_alerts(context.alerts_raised)
+            logger.info(
+                "Recorded context in DB.",
+                output_chunks=len(context.output_responses),
+                alerts=len(context.alerts_raised),
+            )
         except Exception as e:
-            logger.error(f"Failed to record context: {context}.", error=str(e))
+            logger.error("Failed to record context.", prompt_id=context.prompt_id, error=str(e))
 
     async def add_workspace(self, workspace_name: str) -> WorkspaceRow:
         """Add a new workspace to the DB.
@@ -457,11 +618,12 @@ class DbRecorder(DbCodeGate):
             UPDATE provider_endpoints
             SET auth_type = :auth_type, auth_blob = :auth_blob
             WHERE id = :provider_endpoint_id
-            RETURNING id as provider_endpoint_id, auth_type, auth_blob
             """
         )
         # Here we DONT want to return the result
-        _ = await self._execute_update_pydantic_model(auth_material, sql, should_raise=True)
+        await self._execute_update_pydantic_model(
+            auth_material, sql, should_raise=True, fetch=False
+        )
         return
 
     async def add_provider_model(self, model: ProviderModel) -> ProviderModel:
@@ -519,6 +681,39 @@ class DbRecorder(DbCodeGate):
 class DbReader(DbCodeGate):
     def __init__(self, sqlite_path: Optional[str] = None):
         super().__init__(sqlite_path)
+        if not hasattr(self, "_read_conn"):
+            self._read_conn: Optional[AsyncConnection] = None
+            self._read_lock: Optional[asyncio.Lock] = None
+            self._read_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    @asynccontextmanager
+    async def _read_connection(self) -> AsyncIterator[AsyncConnection]:
+        """
+        Yield the long-lived connection shared by all the reads.
+
+        Opening a connection per query means a pool checkout plus a reset and a commit on every
+        call, each of them a round trip to the aiosqlite thread. The engine runs in AUTOCOMMIT
+        and the DB in WAL mode, so a shared connection never holds a stale read snapshot.
+        """
+        loop = asyncio.get_running_loop()
+        stale_conn = None
+        if self._read_loop is not loop:
+            # The CLI runs some queries with asyncio.run before starting the server. The lock
+            # and the connection can't be carried over from a previous event loop. They are
+            # swapped before awaiting anything so concurrent callers share the new ones.
+            stale_conn, self._read_conn = self._read_conn, None
+            self._read_loop = loop
+            self._read_lock = asyncio.Lock()
+
+        async with self._read_lock:
+            if stale_conn is not None:
+                try:
+                    await stale_conn.close()
+                except Exception as e:
+                    logger.debug("Failed to close previous read connection.", error=str(e))
+            if self._read_conn is None or self._read_conn.closed or self._read_conn.invalidated:
+                self._read_conn = await self._async_db_engine.connect()
+            yield self._read_conn
 
     async def _dump_result_to_pydantic_model(
         self, model_type: Type[BaseModel], result: CursorResult
@@ -535,7 +730,7 @@ class DbReader(DbCodeGate):
     async def _execute_select_pydantic_model(
         self, model_type: Type[BaseModel], sql_command: TextClause
     ) -> Optional[List[BaseModel]]:
-        async with self._async_db_engine.begin() as conn:
+        async with self._read_connection() as conn:
             try:
                 result = await conn.execute(sql_command)
                 return await self._dump_result_to_pydantic_model(model_type, result)
@@ -550,7 +745,7 @@ class DbReader(DbCodeGate):
         conditions: dict,
         should_raise: bool = False,
     ) -> Optional[List[BaseModel]]:
-        async with self._async_db_engine.begin() as conn:
+        async with self._read_connection() as conn:
             try:
                 result = await conn.execute(sql_command, conditions)
                 return await self._dump_result_to_pydantic_model(model_type, result)
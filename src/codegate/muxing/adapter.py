@@ -1,12 +1,10 @@
-import copy
 import json
+import time
 import uuid
 from typing import Union
 
 import structlog
 from fastapi.responses import JSONResponse, StreamingResponse
-from litellm import ModelResponse
-from litellm.types.utils import Delta, StreamingChoices
 from ollama import ChatResponse
 
 from codegate.db import models as db_models
@@ -15,6 +13,17 @@ from codegate.providers.ollama.adapter import OLlamaToModel
 
 logger = structlog.get_logger("codegate")
 
+# Providers whose endpoint needs the /v1 suffix in base_url.
+V1_URL_PROVIDERS = frozenset({db_models.ProviderType.openai, db_models.ProviderType.openrouter})
+# Providers whose responses are already in OpenAI format.
+OPENAI_FORMAT_PROVIDERS = frozenset(
+    {
+        db_models.ProviderType.openai,
+        db_models.ProviderType.openrouter,
+        db_models.ProviderType.llamacpp,
+    }
+)
+
 
 class MuxingAdapterError(Exception):
     pass
@@ -30,16 +39,18 @@ class BodyAdapter:
 
     def _get_provider_formatted_url(self, model_route: rulematcher.ModelRoute) -> str:
         """Get the provider formatted URL to use in base_url. Note this value comes from DB"""
-        if model_route.endpoint.provider_type in [
-            db_models.ProviderType.openai,
-            db_models.ProviderType.openrouter,
-        ]:
+        if model_route.endpoint.provider_type in V1_URL_PROVIDERS:
             return f"{model_route.endpoint.endpoint}/v1"
         return model_route.endpoint.endpoint
 
     def set_destination_info(self, model_route: rulematcher.ModelRoute, data: dict) -> dict:
-        """Set the destination provider info."""
-        new_data = copy.deepcopy(data)
+        """
+        Set the destination provider info.
+
+        Only top-level keys are replaced, so a shallow copy is enough. The nested messages are
+        shared with the original body, which is not used after routing.
+        """
+        new_data = {**data}
         new_data["model"] = model_route.model.name
         new_data["base_url"] = self._get_provider_formatted_url(model_route)
         return new_data
@@ -52,40 +63,43 @@ class StreamChunkFormatter:
     In Continue this means setting "provider": "openai" in the config json file.
     """
 
-    def __init__(self):
-        self.provider_to_func = {
-            db_models.ProviderType.ollama: self._format_ollama,
-            db_models.ProviderType.openai: self._format_openai,
-            db_models.ProviderType.anthropic: self._format_antropic,
-            # Our Lllamacpp provider emits OpenAI chunks
-            db_models.ProviderType.llamacpp: self._format_openai,
-            # OpenRouter is a dialect of OpenAI
-            db_models.ProviderType.openrouter: self._format_openai,
-        }
-
-    def _format_ollama(self, chunk: str) -> str:
+    @staticmethod
+    def _remove_data_prefix(chunk: str) -> str:
+        """
+        Get the payload after the "data:" field of a SSE chunk. Anthropic chunks carry an
+        "event:" line before it, so the prefix is not always at the start of the chunk. Chunks
+        without a "data:" field are returned as they are instead of being dropped.
+        """
+        head, sep, tail = chunk.partition("data:")
+        return (tail if sep else head).strip()
+
+    @staticmethod
+    def _format_ollama(chunk: str) -> str:
         """Format the Ollama chunk to OpenAI format."""
+        # For some clients our Ollama provider already emits OpenAI chunks. A key can only
+        # appear followed by a colon, so a substring check is enough to detect them.
+        if '"choices":' in chunk:
+            return StreamChunkFormatter._remove_data_prefix(chunk)
         try:
-            chunk_dict = json.loads(chunk)
-            ollama_chunk = ChatResponse(**chunk_dict)
+            # Parse and validate the chunk in a single pass, without an intermediate dict
+            ollama_chunk = ChatResponse.model_validate_json(chunk)
             open_ai_chunk = OLlamaToModel.normalize_chunk(ollama_chunk)
             return open_ai_chunk.model_dump_json(exclude_none=True, exclude_unset=True)
         except Exception:
             return chunk
 
-    def _format_openai(self, chunk: str) -> str:
-        """The chunk is already in OpenAI format. To standarize remove the "data:" prefix."""
-        cleaned_chunk = chunk.split("data:")[1].strip()
-        try:
-            chunk_dict = json.loads(cleaned_chunk)
-            open_ai_chunk = ModelResponse(**chunk_dict)
-            return open_ai_chunk.model_dump_json(exclude_none=True, exclude_unset=True)
-        except Exception:
-            return cleaned_chunk
+    @staticmethod
+    def _format_openai(chunk: str) -> str:
+        """
+        The chunk is already in OpenAI format. To standarize remove the "data:" prefix.
+        There's no need to parse it, it's sent as is to the client.
+        """
+        return StreamChunkFormatter._remove_data_prefix(chunk)
 
-    def _format_antropic(self, chunk: str) -> str:
+    @staticmethod
+    def _format_antropic(chunk: str) -> str:
         """Format the Anthropic chunk to OpenAI format."""
-        cleaned_chunk = chunk.split("data:")[1].strip()
+        cleaned_chunk = StreamChunkFormatter._remove_data_prefix(chunk)
         try:
             chunk_dict = json.loads(cleaned_chunk)
             msg_type = chunk_dict.get("type", "")
@@ -102,27 +116,38 @@ class StreamChunkFormatter:
                 return ""
 
             msg_content = msg_content_dict.get("text", "")
-            open_ai_chunk = ModelResponse(
-                id=f"anthropic-chat-{str(uuid.uuid4())}",
-                model="anthropic-muxed-model",
-                object="chat.completion.chunk",
-                choices=[
-                    StreamingChoices(
-                        finish_reason=finish_reason,
-                        index=0,
-                        delta=Delta(content=msg_content, role="assistant"),
-                        logprobs=None,
-                    )
-                ],
-            )
-            return open_ai_chunk.model_dump_json(exclude_none=True, exclude_unset=True)
+            # Build the OpenAI chunk directly, it's serialized right away so there's no need
+            # to validate it through a ModelResponse.
+            choice = {"index": 0, "delta": {"content": msg_content, "role": "assistant"}}
+            if finish_reason:
+                choice["finish_reason"] = finish_reason
+            open_ai_chunk = {
+                "id": f"anthropic-chat-{uuid.uuid4().hex}",
+                "created": int(time.time()),
+                "model": "anthropic-muxed-model",
+                "object": "chat.completion.chunk",
+                "choices": [choice],
+            }
+            return json.dumps(open_ai_chunk, separators=(",", ":"))
         except Exception:
-            return cleaned_chunk.strip()
+            return cleaned_chunk
 
-    def format(self, chunk: str, dest_prov: db_models.ProviderType) -> ModelResponse:
+    # The formatters are stateless, so the mapping is built once for the class.
+    provider_to_func = {
+        db_models.ProviderType.ollama: _format_ollama,
+        db_models.ProviderType.openai: _format_openai,
+        db_models.ProviderType.anthropic: _format_antropic,
+        # Our Lllamacpp provider emits OpenAI chunks
+        db_models.ProviderType.llamacpp: _format_openai,
+        # OpenRouter is a dialect of OpenAI
+        db_models.ProviderType.openrouter: _format_openai,
+    }
+
+    @classmethod
+    def format(cls, chunk: str, dest_prov: db_models.ProviderType) -> str:
         """Format the chunk to OpenAI format."""
         # Get the format function
-        format_func = self.provider_to_func.get(dest_prov)
+        format_func = cls.provider_to_func.get(dest_prov)
         if format_func is None:
             raise MuxingAdapterError(f"Provider {dest_prov} not supported.")
         return format_func(chunk)
@@ -130,9 +155,6 @@ class StreamChunkFormatter:
 
 class ResponseAdapter:
 
-    def __init__(self):
-        self.stream_formatter = StreamChunkFormatter()
-
     def _format_as_openai_chunk(self, formatted_chunk: str) -> str:
         """Format the chunk as OpenAI chunk. This is the format how the clients expect the data."""
         return f"data:{formatted_chunk}\n\n"
@@ -142,7 +164,7 @@ class ResponseAdapter:
     ):
         """Format the streaming response to OpenAI format."""
         async for chunk in response.body_iterator:
-            openai_chunk = self.stream_formatter.format(chunk, dest_prov)
+            openai_chunk = StreamChunkFormatter.format(chunk, dest_prov)
             # Sometimes for Anthropic we couldn't get content from the chunk. Skip it.
             if not openai_chunk:
                 continue
@@ -160,5 +182,7 @@ class ResponseAdapter:
                 background=response.background,
                 media_type=response.media_type,
             )
-        else:
-            raise MuxingAdapterError("Only streaming responses are supported.")
+        # Non-streaming responses can only be forwarded if they're already in OpenAI format
+        if isinstance(response, JSONResponse) and dest_prov in OPENAI_FORMAT_PROVIDERS:
+            return response
+        raise MuxingAdapterError("Only streaming responses are supported.")
@@ -79,8 +79,8 @@ class StorageEngine:
             raise
 
     def _setup_schema(self):
-        cursor = self.conn.cursor()
-        cursor.execute(
+        # Run the whole schema in a single call instead of a statement at a time
+        self.conn.executescript(
             """
             CREATE TABLE IF NOT EXISTS packages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -89,17 +89,15 @@ class StorageEngine:
                 status TEXT NOT NULL,
                 description TEXT,
                 embedding BLOB
-            )
+            );
+
+            -- Create indexes for faster querying
+            CREATE INDEX IF NOT EXISTS idx_name ON packages(name);
+            CREATE INDEX IF NOT EXISTS idx_type ON packages(type);
+            CREATE INDEX IF NOT EXISTS idx_status ON packages(status);
         """
         )
 
-        # Create indexes for faster querying
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_name ON packages(name)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_type ON packages(type)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_status ON packages(status)")
-
-        self.conn.commit()
-
     async def search_by_property(self, name: str, properties: List[str]) -> list[dict]:
         if len(properties) == 0:
             return []
@@ -0,0 +1,149 @@
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+from sqlalchemy import text
+
+from codegate.api.v1_processing import parse_output
+from codegate.db import connection
+from codegate.db.models import Alert, AlertSeverity
+from codegate.pipeline.base import PipelineContext
+
+
+@pytest.fixture
+def db_recorder(tmp_path):
+    """Create a migrated DB in a temporary path and the recorder and reader singletons for it."""
+    db_path = tmp_path / "codegate.db"
+    connection.init_db_sync(str(db_path))
+    connection.DbRecorder._instance = None
+    connection.DbReader._instance = None
+    connection.DbReader(str(db_path))
+    yield connection.DbRecorder(str(db_path))
+    connection.DbRecorder._instance = None
+    connection.DbReader._instance = None
+
+
+async def _count_rows(table: str) -> int:
+    async with connection.DbReader()._read_connection() as conn:
+        result = await conn.execute(text(f"SELECT COUNT(*) FROM {table}"))  # nosec
+        return result.scalar()
+
+
+def _create_context(severity: AlertSeverity = AlertSeverity.INFO) -> PipelineContext:
+    context = PipelineContext()
+    context.add_input_request(
+        {"messages": [{"role": "user", "content": "Hello"}]},
+        is_fim_request=False,
+        provider="openai",
+    )
+    context.add_output({"choices": [{"delta": {"content": "Hi"}}]})
+    context.add_output({"choices": [{"delta": {"content": " there"}}]})
+    context.add_alert("test-step", severity, trigger_string="secret")
+    return context
+
+
+@pytest.mark.asyncio
+async def test_record_context_concurrent_writes(db_recorder):
+    await asyncio.gather(*[db_recorder.record_context(_create_context()) for _ in range(20)])
+
+    assert await _count_rows("prompts") == 20
+    assert await _count_rows("outputs") == 20
+    assert await _count_rows("alerts") == 20
+
+
+@pytest.mark.asyncio
+async def test_record_context_stores_outputs_as_json_list(db_recorder):
+    context = _create_context()
+    await db_recorder.record_context(context)
+
+    workspace = await connection.DbReader().get_workspace_by_name("default")
+    rows = await connection.DbReader().get_prompts_with_output(workspace.id)
+
+    assert len(rows) == 1
+    stored_output = json.loads(rows[0].output)
+    assert isinstance(stored_output, list)
+    assert all(isinstance(chunk, dict) for chunk in stored_output)
+    assert await parse_output(rows[0].output) == "Hi there"
+
+
+@pytest.mark.asyncio
+async def test_record_context_fim_update_single_write(db_recorder, monkeypatch):
+    context = _create_context()
+    await db_recorder.record_context(context)
+
+    updated_context = _create_context()
+    updated_context.input_request.request = '{"messages": "updated"}'
+    monkeypatch.setattr(
+        db_recorder,
+        "_should_record_context",
+        lambda _: (True, "update", context.input_request.id),
+    )
+    writes = []
+    write = db_recorder._write
+
+    async def _spy_write(statements):
+        writes.append(statements)
+        await write(statements)
+
+    monkeypatch.setattr(db_recorder, "_write", _spy_write)
+    await db_recorder.record_context(updated_context)
+
+    # The request update is committed together with the outputs and alerts.
+    assert len(writes) == 1
+    assert [sql for sql, _ in writes[0]] == [
+        connection.UPDATE_PROMPT_SQL,
+        connection.INSERT_OUTPUT_SQL,
+        connection.INSERT_ALERT_SQL,
+    ]
+    assert await _count_rows("prompts") == 1
+    workspace = await connection.DbReader().get_workspace_by_name("default")
+    prompts = await connection.DbReader().get_prompts_with_output(workspace.id)
+    assert {prompt.request for prompt in prompts} == {'{"messages": "updated"}'}
+
+
+@pytest.mark.asyncio
+async def test_record_alerts_failure_is_isolated(db_recorder):
+    orphan_alert = Alert(
+        id="orphan",
+        prompt_id="non-existing-prompt",
+        code_snippet=None,
+        trigger_string="secret",
+        trigger_type="test-step",
+        trigger_category=AlertSeverity.INFO,
+        timestamp=datetime.now(timezone.utc),
+    )
+
+    recorded_alerts, _ = await asyncio.gather(
+        db_recorder.record_alerts([orphan_alert], None),
+        db_recorder.record_context(_create_context()),
+    )
+
+    assert recorded_alerts == []
+    assert await _count_rows("prompts") == 1
+    assert await _count_rows("alerts") == 1
+
+
+@pytest.mark.asyncio
+async def test_record_alerts_notifies_critical_once(db_recorder):
+    while not connection.alert_queue.empty():
+        connection.alert_queue.get_nowait()
+    context = _create_context(AlertSeverity.CRITICAL)
+    context.add_alert("test-step", AlertSeverity.CRITICAL, trigger_string="another secret")
+
+    await db_recorder.record_context(context)
+
+    assert await _count_rows("alerts") == 2
+    assert connection.alert_queue.qsize() == 1
+
+
+def test_read_connection_shared_across_event_loops(db_recorder):
+    db_reader = connection.DbReader()
+
+    async def _concurrent_reads():
+        await asyncio.gather(*[db_reader.get_sessions() for _ in range(20)])
+        return db_reader._async_db_engine.pool.checkedout()
+
+    asyncio.run(db_reader.get_sessions())
+    # The connection of the previous loop is replaced by a single new one.
+    assert asyncio.run(_concurrent_reads()) == 1
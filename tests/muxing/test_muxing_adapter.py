@@ -0,0 +1,125 @@
+import json
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from codegate.db import models as db_models
+from codegate.muxing.adapter import MuxingAdapterError, ResponseAdapter, StreamChunkFormatter
+
+openai_chunk = {
+    "id": "chatcmpl-123",
+    "object": "chat.completion.chunk",
+    "created": 1733246717,
+    "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "delta": {"content": "Hello"}, "finish_reason": None}],
+}
+
+
+@pytest.mark.parametrize(
+    "provider",
+    [
+        db_models.ProviderType.openai,
+        db_models.ProviderType.openrouter,
+        db_models.ProviderType.llamacpp,
+    ],
+)
+def test_format_openai_chunk_passthrough(provider):
+    chunk = f"data: {json.dumps(openai_chunk)}\n\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, provider)
+
+    assert formatted_chunk == json.dumps(openai_chunk)
+
+
+def test_format_openai_chunk_with_data_in_content():
+    chunk_dict = {**openai_chunk, "choices": [{"index": 0, "delta": {"content": "data: 1"}}]}
+    chunk = f"data:{json.dumps(chunk_dict)}\n\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, db_models.ProviderType.openai)
+
+    assert json.loads(formatted_chunk) == chunk_dict
+
+
+def test_format_openai_chunk_without_data_field():
+    chunk = f"{json.dumps(openai_chunk)}\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, db_models.ProviderType.openai)
+
+    assert formatted_chunk == json.dumps(openai_chunk)
+
+
+@pytest.mark.parametrize(
+    "anthropic_chunk, expected_content",
+    [
+        (
+            {"type": "content_block_start", "content_block": {"type": "text", "text": "Hi"}},
+            "Hi",
+        ),
+        (
+            {"type": "content_block_delta", "delta": {"type": "text_delta", "text": " there"}},
+            " there",
+        ),
+    ],
+)
+def test_format_anthropic_chunk(anthropic_chunk, expected_content):
+    chunk = f"event: {anthropic_chunk['type']}\ndata:{json.dumps(anthropic_chunk)}\n\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, db_models.ProviderType.anthropic)
+
+    chunk_dict = json.loads(formatted_chunk)
+    assert chunk_dict["id"].startswith("anthropic-chat-")
+    assert chunk_dict["object"] == "chat.completion.chunk"
+    assert chunk_dict["model"] == "anthropic-muxed-model"
+    assert chunk_dict["choices"] == [
+        {"index": 0, "delta": {"content": expected_content, "role": "assistant"}}
+    ]
+
+
+def test_format_anthropic_chunk_without_content():
+    chunk = f"event: message_stop\ndata:{json.dumps({'type': 'message_stop'})}\n\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, db_models.ProviderType.anthropic)
+
+    assert formatted_chunk == ""
+
+
+def test_format_ollama_chunk():
+    ollama_chunk = {
+        "model": "llama3",
+        "created_at": "2024-01-01T00:00:00Z",
+        "message": {"role": "assistant", "content": "Hi"},
+        "done": False,
+    }
+
+    formatted_chunk = StreamChunkFormatter().format(
+        json.dumps(ollama_chunk), db_models.ProviderType.ollama
+    )
+
+    chunk_dict = json.loads(formatted_chunk)
+    assert chunk_dict["model"] == "llama3"
+    assert chunk_dict["choices"][0]["delta"] == {"content": "Hi", "role": "assistant"}
+
+
+def test_format_ollama_openai_chunk_passthrough():
+    chunk = f"\ndata: {json.dumps(openai_chunk)}\n"
+
+    formatted_chunk = StreamChunkFormatter().format(chunk, db_models.ProviderType.ollama)
+
+    assert formatted_chunk == json.dumps(openai_chunk)
+
+
+def test_format_json_response_openai_passthrough():
+    response = JSONResponse(content=openai_chunk)
+
+    formatted_response = ResponseAdapter().format_response_to_client(
+        response, db_models.ProviderType.openai
+    )
+
+    assert formatted_response is response
+
+
+def test_format_json_response_not_openai_format():
+    response = JSONResponse(content={"message": {"content": "Hi"}})
+
+    with pytest.raises(MuxingAdapterError):
+        ResponseAdapter().format_response_to_client(response, db_models.ProviderType.ollama)